@@ -1,10 +1,27 @@
 from netmiko.ssh_exception import AuthenticationException, NetMikoTimeoutException
 from netmiko import ConnectHandler
 import re
+import sys
+import time
 from datetime import datetime
 import os.path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from bisect import bisect_right
 import json
 
+try:
+    from orjson import loads as json_loads  # Faster parser, if installed
+except ImportError:
+    from json import loads as json_loads
+
+# Regular expressions for parsing device output, compiled once:
+_RE_IFACE_SESS = re.compile(r'(\S+\d/\d/\d)\s+(\d+)')
+_RE_IFACE_NUM = re.compile(r'\S+(\d/\d/\d)')
+
+# Pado delay values, corresponding to ascending session thresholds:
+_PADO_DELAYS = (0, 256, 512, 9999)
+
 
 def connection_to_iosxe(ssh_username, ssh_password, device_ip):
     """
@@ -12,32 +29,45 @@ def connection_to_iosxe(ssh_username, ssh_password, device_ip):
     :param ssh_username: str, username for an ssh connection
     :param ssh_password: str, password for an ssh connection
     :param device_ip: str, ip address of device
-    :return: connection, established via netmiko
+    :return: tuple, connection established via netmiko (or None) and str, reason of failure (or None)
     """
     connection_settings = {
         'device_type': 'cisco_xe',
         'ip': device_ip,
         'username': ssh_username,
         'password': ssh_password,
+        'fast_cli': True,
+        'global_cmd_verify': False,  # Not waiting for commands echo
+        # Capping blocking time on unreachable or slow devices:
+        'conn_timeout': 10,
+        'auth_timeout': 10,
+        'banner_timeout': 10,
     }
 
-    i = 0
+    attempts = 3
 
-    while i < 3:  # 3 tries to connect
+    for attempt in range(attempts):
         try:
             ssh_connection = ConnectHandler(**connection_settings)
-        except AuthenticationException:
-            print(r'Wrong username\password.')
-            i += 1
+        except AuthenticationException:  # Credentials won't change between tries, so not retrying
+            return None, 'wrong username\\password'
         except NetMikoTimeoutException:
-            print(f'{device_ip} is unreachable. Trying again...')
-            i += 1
+            if attempt < attempts - 1:
+                time.sleep(0.5 * 2 ** attempt)  # Backing off exponentially: 0.5, then 1 second
         else:
-            print('Successfully authenticated.')
-            return ssh_connection
+            return ssh_connection, None
 
-    print(f'Cannot connect to {device_ip}. Skipping')
-    return None
+    return None, f'unreachable after {attempts} tries'
+
+
+def _prompt_pattern(ssh_connection):
+    """
+
+    :param ssh_connection: connection, established via netmiko
+    :return: str, regex matching the full privileged prompt of device (such as HOSTNAME#)
+    """
+    # Bare hostname may occur in command output, and commands echo isn't verified, so '#' is required:
+    return re.escape(ssh_connection.base_prompt) + r'#'
 
 
 def get_interfaces_and_sessions(ssh_connection):
@@ -47,9 +77,13 @@ def get_interfaces_and_sessions(ssh_connection):
     :return: list of tuples, which contain interface name and sessions number values
     """
 
-    return re.findall(r'(\S+\d/\d/\d)\s+(\d+)', ssh_connection.send_command('show pppoe summary'))
+    output = ssh_connection.send_command('show pppoe summary', expect_string=_prompt_pattern(ssh_connection),
+                                         read_timeout=15)
 
+    return _RE_IFACE_SESS.findall(output)
 
+
+@lru_cache(maxsize=4096)  # Called both for logging and for bba-group names of the same interface
 def get_interface_number(interface_name):
     """
 
@@ -57,7 +91,7 @@ def get_interface_number(interface_name):
     :return: str, number of interface (such as 0/0/1)
     """
 
-    interface_number = re.search(r'\S+(\d/\d/\d)', interface_name).group(1)
+    interface_number = _RE_IFACE_NUM.search(interface_name).group(1)
 
     return interface_number
 
@@ -81,18 +115,73 @@ def get_pado_delay(sessions_number, threshold_256, threshold_512, threshold_9999
     :param threshold_256: int, if number of sessions reaches the threshold, pado delay will be 256
     :param threshold_512: int, if number of sessions reaches the threshold, pado delay will be 512
     :param threshold_9999: int, if number of sessions reaches the threshold, pado delay will be 9999
-    :return:
-    """
-    if sessions_number < threshold_256:
-        pado_delay = 0
-    elif threshold_256 <= sessions_number < threshold_512:
-        pado_delay = 256
-    elif threshold_512 <= sessions_number < threshold_9999:
-        pado_delay = 512
-    else:
-        pado_delay = 9999
+    :return: int, pado delay value
+    """
+    # Index of the first threshold greater than sessions_number is the index of pado delay value:
+    return _PADO_DELAYS[bisect_right((threshold_256, threshold_512, threshold_9999), sessions_number)]
+
+
+def get_pado_delay_new_dict(interfaces_and_pado_list):
+    """
+
+    :param interfaces_and_pado_list: list of pair of all BRAS' interfaces and corresponding pado delay values
+    :return: dict, bba_group_name:pado_delay values to be applied
+    """
+    return {bba_group_name: pado_delay
+            for interface_name, pado_delay in interfaces_and_pado_list
+            for bba_group_name in get_bba_group_names(interface_name)}
 
-    return pado_delay
+
+def get_pado_delay_cached_dict(state_cache, device_ip, state_cache_ttl):
+    """
+
+    :param state_cache: dict, device_ip:{'pado_delay_dict': ..., 'timestamp': ...} values from previous runs
+    :param device_ip: str, ip address of device
+    :param state_cache_ttl: int, seconds during which cached pado delay values are trusted
+    :return: dict, bba_group_name:pado_delay values checked on device recently, or None if there are no such
+    """
+    device_state = state_cache.get(device_ip)
+    if device_state is None or time.time() - device_state['timestamp'] >= state_cache_ttl:
+        return None
+
+    return device_state['pado_delay_dict']
+
+
+def load_state_cache(state_cache_path):
+    """
+
+    :param state_cache_path: str, path to state cache file
+    :return: dict, device_ip:{'pado_delay_dict': ..., 'timestamp': ...} values, empty if there is no valid file
+    """
+    try:
+        with open(state_cache_path, 'rb') as state_cache_file:
+            state_cache = json_loads(state_cache_file.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    # Discarding a cache of unexpected structure, so it can't break handling of BRASes:
+    if not isinstance(state_cache, dict) or not all(
+            isinstance(device_state, dict)
+            and isinstance(device_state.get('pado_delay_dict'), dict)
+            and isinstance(device_state.get('timestamp'), (int, float))
+            for device_state in state_cache.values()):
+        return {}
+
+    return state_cache
+
+
+def save_state_cache(state_cache_path, state_cache):
+    """
+
+    :param state_cache_path: str, path to state cache file
+    :param state_cache: dict, device_ip:{'pado_delay_dict': ..., 'timestamp': ...} values
+    :return: None
+    """
+    # Writing to a temporary file first, so an interrupted run can't leave a broken cache:
+    temp_path = state_cache_path + '.tmp'
+    with open(temp_path, 'w') as state_cache_file:
+        json.dump(state_cache, state_cache_file)
+    os.replace(temp_path, state_cache_path)
 
 
 def get_pado_delay_current_dict(ssh_connection):
@@ -101,16 +190,25 @@ def get_pado_delay_current_dict(ssh_connection):
     :param ssh_connection: connection, established via netmiko
     :return: dict, bba_group_name:pado_delay_current values
     """
+    # Fetching bba config at most once per connection, until it's changed by set_pado_delay:
+    if hasattr(ssh_connection, '_pado_cache'):
+        return ssh_connection._pado_cache
+
     pado_delay_current_dict = {}  # Dictionary for pairs of bba_group_name:pado_delay_current_dict
 
-    for line in ssh_connection.send_command('sh run | sec bba').split(sep='\n'):
+    output = ssh_connection.send_command('sh run | sec bba', expect_string=_prompt_pattern(ssh_connection),
+                                         read_timeout=15)
+
+    for line in output.splitlines():
         if line.startswith('bba-group pppoe'):
-            bba_group_name = re.search(r'bba-group pppoe (\S+)', line).group(1)
+            bba_group_name = line.split()[2]  # 'bba-group pppoe <name>'
             pado_delay_current_dict[bba_group_name] = 0
         elif line.startswith(' pado delay'):
-            pado_delay_current = re.search(r'pado delay (\S+)', line).group(1)
+            pado_delay_current = line.split()[2]  # ' pado delay <value>'
             pado_delay_current_dict[bba_group_name] = int(pado_delay_current)
 
+    ssh_connection._pado_cache = pado_delay_current_dict
+
     return pado_delay_current_dict
 
 
@@ -157,37 +255,35 @@ def set_pado_delay(ssh_connection, interfaces_and_pado_list):
 
     config_set = create_pado_config_set(ssh_connection, interfaces_and_pado_list)
     if config_set:  # If config_set is not empty
+        # Sending changes for all interfaces at once, within a single config mode session:
         ssh_connection.send_config_set(config_set)
+        del ssh_connection._pado_cache  # Cached bba config is outdated now
 
 
-def main():
-    # Path to parameters file:
-    parameters_path = os.path.join(os.path.dirname(__file__), 'parameters.json')
-
-    # Loading parameters from parameters.json:
-    with open(parameters_path) as parameters_file:
-        parameters = json.load(parameters_file)
-        ssh_username = parameters['ssh_username']
-        ssh_password = parameters['ssh_password']
-        threshold_256 = parameters['threshold_256']
-        threshold_512 = parameters['threshold_512']
-        threshold_9999 = parameters['threshold_9999']
-        bras_dict = parameters['bras_dict']
-
-    print(f'{datetime.now()} Starting the pppoe_session_balancing script as {ssh_username}')
-    print(
-        f'{datetime.now()} Current thresholds are {threshold_256} for 256, {threshold_512} for 512, {threshold_9999} for 9999')
+def process_bras(device_ip, bras_name, ssh_username, ssh_password, threshold_256, threshold_512, threshold_9999,
+                 state_cache, state_cache_ttl):
+    """
 
-    for device_ip in bras_dict.keys():
-        if device_ip.startswith('#'):  # handling comment lines
-            continue
-        log_message = bras_dict[device_ip] + '>> '
-        print(f'{datetime.now()} Connecting to {bras_dict[device_ip]}... ', end='')
+    :param device_ip: str, ip address of BRAS
+    :param bras_name: str, hostname of BRAS used in log messages
+    :param ssh_username: str, username for an ssh connection
+    :param ssh_password: str, password for an ssh connection
+    :param threshold_256: int, if number of sessions reaches the threshold, pado delay will be 256
+    :param threshold_512: int, if number of sessions reaches the threshold, pado delay will be 512
+    :param threshold_9999: int, if number of sessions reaches the threshold, pado delay will be 9999
+    :param state_cache: dict, device_ip:{'pado_delay_dict': ..., 'timestamp': ...} values, updated in place
+    :param state_cache_ttl: int, seconds during which cached pado delay values are trusted
+    :return: str, log message with pado delay values calculated for BRAS' interfaces
+    """
+    log_parts = [bras_name, '>> ']  # Joined into a log message once all interfaces are handled
+    ssh_connection = None
 
+    # Any failure is reported in this BRAS' log message only, so other BRASes are still handled and logged:
+    try:
         # Connecting to device:
-        ssh_connection = connection_to_iosxe(ssh_username, ssh_password, device_ip)
+        ssh_connection, connection_error = connection_to_iosxe(ssh_username, ssh_password, device_ip)
         if ssh_connection is None:  # If a connection failed, skipping this BRAS
-            continue
+            return f'{datetime.now()} {bras_name}>> {connection_error}, skipped'
 
         # Creating a list with pairs of BRAS' interfaces and corresponding pado delay values:
         interfaces_and_pado_list = []
@@ -196,15 +292,66 @@ def main():
         for interface_name, sessions_num in get_interfaces_and_sessions(ssh_connection):
             # Calculating pado delay value to be applied to bba-group according to thresholds:
             pado_delay = get_pado_delay(int(sessions_num), threshold_256, threshold_512, threshold_9999)
-            log_message += get_interface_number(interface_name) + ': PADO=' + str(pado_delay) + ', '
+            log_parts += [get_interface_number(interface_name), ': PADO=', str(pado_delay), ', ']
 
             # Adding interface-pado info to common list:
             interfaces_and_pado_list.append([interface_name, pado_delay])
 
-        # Send interfaces-pado common list to be applied on BRASes:
-        set_pado_delay(ssh_connection, interfaces_and_pado_list)
+        # Skipping bba config check, if the same pado delay values were recently checked on BRAS:
+        pado_delay_new_dict = get_pado_delay_new_dict(interfaces_and_pado_list)
+        if pado_delay_new_dict != get_pado_delay_cached_dict(state_cache, device_ip, state_cache_ttl):
+            # Send interfaces-pado common list to be applied on BRAS:
+            set_pado_delay(ssh_connection, interfaces_and_pado_list)
+            state_cache[device_ip] = {'pado_delay_dict': pado_delay_new_dict, 'timestamp': time.time()}
+    except Exception as exc:
+        return f'{datetime.now()} {"".join(log_parts)}failed: {exc!r}'
+    finally:
+        if ssh_connection is not None:
+            ssh_connection.disconnect()
+
+    return f'{datetime.now()} {"".join(log_parts)}'
+
+
+def main():
+    # Path to parameters file:
+    parameters_path = os.path.join(os.path.dirname(__file__), 'parameters.json')
+    # Path to file with pado delay values checked on previous runs:
+    state_cache_path = os.path.join(os.path.dirname(__file__), 'state_cache.json')
+
+    # Loading parameters from parameters.json:
+    with open(parameters_path, 'rb') as parameters_file:
+        parameters = json_loads(parameters_file.read())
+        ssh_username = parameters['ssh_username']
+        ssh_password = parameters['ssh_password']
+        threshold_256 = parameters['threshold_256']
+        threshold_512 = parameters['threshold_512']
+        threshold_9999 = parameters['threshold_9999']
+        # Dropping devices, which are commented out with '#':
+        bras_dict = {device_ip: bras_name for device_ip, bras_name in parameters['bras_dict'].items()
+                     if not device_ip.startswith('#')}
+        max_workers = parameters.get('max_workers', 32)  # Number of BRASes handled concurrently
+        state_cache_ttl = parameters.get('state_cache_ttl', 3600)  # Seconds during which cached values are trusted
+
+    # Pado delay lookup relies on ascending thresholds, so a typo mustn't silently set wrong values:
+    if not threshold_256 <= threshold_512 <= threshold_9999:
+        sys.exit(f'{datetime.now()} Thresholds must be ascending, but they are {threshold_256} for 256, '
+                 f'{threshold_512} for 512, {threshold_9999} for 9999. Exiting')
+
+    state_cache = load_state_cache(state_cache_path)
+
+    print(f'{datetime.now()} Starting the pppoe_session_balancing script as {ssh_username}')
+    print(
+        f'{datetime.now()} Current thresholds are {threshold_256} for 256, {threshold_512} for 512, {threshold_9999} for 9999')
+
+    # Handling BRASes concurrently, one ssh connection per worker thread:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_bras, device_ip, bras_dict[device_ip], ssh_username, ssh_password,
+                                   threshold_256, threshold_512, threshold_9999, state_cache, state_cache_ttl)
+                   for device_ip in bras_dict]
+        for future in as_completed(futures):
+            print(future.result())
 
-        print(f'{datetime.now()} {log_message}')
+    save_state_cache(state_cache_path, state_cache)
 
 
 if __name__ == '__main__':